@@ -6,12 +6,15 @@ import time
 import operator
 import requests
 import logging
+import threading
 from datetime import datetime
 
 from . import settings
 
 
 log = logging.getLogger(__name__)
+uppercase = re.compile('(?<!^)([A-Z])')
+pretty_names = {}
 
 
 class Record(dict):
@@ -37,6 +40,7 @@ class ResponseCodes:
     DataInsertSuccess = 201
     DataUpdateSuccess = 202
     DataDeleteSuccess = 203
+    NotModified = 304
     SystemException = 500
     MinorException = 501
     UserException = 502
@@ -61,31 +65,47 @@ class Connector(object):
     def __init__(self, domain, username, password, throttle=0.1):
         host = 'https://' + domain + '.leankit.com'
         self.base_api_url = host + '/Kanban/Api'
-        self.http = requests.sessions.Session()
-        self.http.auth = (username, password)
+        self.auth = (username, password)
+        self.local = threading.local()
         self.last_request_time = time.time() - throttle
         self.throttle = throttle
+        self.lock = threading.Lock()
+        self.etags = {}
+
+    @property
+    def http(self):
+        """ HTTP session of the current thread, as requests does not
+        guarantee that a session can be shared between threads """
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.sessions.Session()
+            self.local.session.auth = self.auth
+        return self.local.session
 
     def post(self, url, data, handle_errors=True):
         data = json.dumps(data)
         return self.do_request("POST", url, data, handle_errors)
 
-    def get(self, url, handle_errors=True):
-        return self.do_request("GET", url, None, handle_errors)
+    def get(self, url, handle_errors=True, conditional=False):
+        return self.do_request("GET", url, None, handle_errors, conditional)
 
-    def do_request(self, action, url, data=None, handle_errors=True):
-        """ Make an HTTP request to the given url possibly POSTing some data. """
+    def do_request(self, action, url, data=None, handle_errors=True, conditional=False):
+        """ Make an HTTP request to the given url possibly POSTing some data.
+        Conditional requests send the last ETag seen for the url and
+        return None if the server replies that nothing has changed. """
         assert self.http is not None, "HTTP connection should not be None"
         headers = {'Content-type': 'application/json'}
+        if conditional and url in self.etags:
+            headers['If-None-Match'] = self.etags[url]
         log.debug('{} {}'.format(action, url))
 
         # Throttle requests to Leankit to be no more than once per THROTTLE
         # seconds.
-        now = time.time()
-        delay = (self.last_request_time + self.throttle) - now
-        if delay > 0:
-            time.sleep(delay)
-        self.last_request_time = time.time()
+        with self.lock:
+            now = time.time()
+            delay = (self.last_request_time + self.throttle) - now
+            if delay > 0:
+                time.sleep(delay)
+            self.last_request_time = time.time()
         try:
             request = self.http.request(
                 method=action,
@@ -97,6 +117,9 @@ class Connector(object):
         except Exception as e:
             raise IOError("Unable to make HTTP request: %s" % e.message)
 
+        if conditional and request.status_code == ResponseCodes.NotModified:
+            return None
+
         if request.status_code not in ResponseCodes.SUCCESS_CODES:
             raise IOError('Kanban error %d' % request.status_code)
 
@@ -104,6 +127,8 @@ class Connector(object):
 
         if handle_errors and response.ReplyCode not in ResponseCodes.EXPECTED_CODES:
             raise IOError('Kanban error %d: %s' % (response.ReplyCode, response.ReplyText))
+        if conditional and 'ETag' in request.headers:
+            self.etags[url] = request.headers['ETag']
         return response
 
 
@@ -124,12 +149,12 @@ class Converter(object):
 
     @staticmethod
     def prettify_name(camelcase):
-        camelcase = camelcase.replace('ID', '_id')
-        if len(camelcase) > 1:
-            camelcase = camelcase[0].lower() + camelcase[1:]
-            return re.sub('([A-Z])', lambda match: '_' + match.group(1).lower(), camelcase)
-        else:
-            return camelcase.lower()
+        try:
+            return pretty_names[camelcase]
+        except KeyError:
+            name = uppercase.sub(r'_\1', camelcase.replace('ID', '_id')).lower()
+            pretty_names[camelcase] = name
+            return name
 
     @staticmethod
     def to_camel_case(name):
@@ -210,9 +235,9 @@ class Card(Converter):
         history = self.board.kanban.connector.get("/Card/History/{board_id}/{card_id}".format(
             board_id=str(self.board.id), card_id=str(self.id))).ReplyData[0]
 
-        for event in history:
+        for index, event in enumerate(history):
             event['DateTime'] = datetime.strptime(event['DateTime'], '%d/%m/%Y at %I:%M:%S %p')
-            event['Position'] = len(history) - history.index(event)
+            event['Position'] = len(history) - index
             event['BoardId'] = self.board.id
 
         self.history = list(reversed(history))
@@ -468,8 +493,14 @@ class Kanban:
 
     def check_updates(self, board_id, version):
         """ Downloads a board if a newer version number exists """
-        board_dict = self.connector.get('/Board/{}/BoardVersion/{}/GetNewerIfExists'.format(board_id, version)).ReplyData[0]
+        url = '/Board/{}/BoardVersion/{}/GetNewerIfExists'.format(board_id, version)
+        response = self.connector.get(url, conditional=True)
+        if response is None:
+            return False
+        board_dict = response.ReplyData[0]
         if board_dict:
+            # The next check asks for the new version, so this url is not requested again
+            self.connector.etags.pop(url, None)
             self.boards[board_id] = Board(self, board_dict)
             return True
         else:
@@ -1,10 +1,47 @@
 # -*- coding: utf-8 -*-
 
 import re
+from itertools import groupby
+from operator import itemgetter
 
 from .database import db
 from .settings import timeutils, today
 
+uppercase = re.compile('(?<!^)([A-Z])')
+snake_cases = {}
+field_names = {}
+projection = {'_id': 0}
+batch_size = 10000
+
+
+def accumulate(entries):
+    """ Aggregates (key, time data) pairs into a dictionary of time data by key """
+    result = {}
+    for key, data in entries:
+        slot = result.get(key)
+        if slot is None:
+            result[key] = {'in': data['in'],
+                           'out': data['out'],
+                           'time': data['time'],
+                           'trt': data['trt'],
+                           'events': data.get('events', 1)}
+        else:
+            slot['trt'] += data['trt']
+            slot['time'] += data['time']
+            slot['out'] = data['out']
+            slot['events'] += data.get('events', 1)
+    return result
+
+
+def select(cards, include={}, exclude={}):
+    """ Returns the cards matching all the include attributes
+    and none of the exclude attributes """
+    include = list(include.items())
+    exclude = list(exclude.items())
+    return [card for card in cards
+            if all(getattr(card, key, None) == value for key, value in include)
+            and not any(getattr(card, key, None) == value for key, value in exclude)]
+
 
 def singleton(method):
     def wrapper(self):
@@ -17,18 +54,27 @@ def singleton(method):
 
 
 class Converter:
+    floats = ()
+
     def __init__(self, data):
-        for attr in data:
-            setattr(self, self.snake_case(attr), data[attr])
+        fields = tuple(data)
+        try:
+            names = field_names[fields]
+        except KeyError:
+            names = field_names[fields] = tuple(self.snake_case(attr) for attr in fields)
+        attributes = dict(zip(names, data.values()))
+        for attr in self.floats:
+            attributes[attr] = float(attributes[attr])
+        self.__dict__.update(attributes)
 
     @staticmethod
     def snake_case(camelcase):
-        camelcase = camelcase.replace('ID', '_id')
-        if len(camelcase) > 1:
-            camelcase = camelcase[0].lower() + camelcase[1:]
-            return re.sub('([A-Z])', lambda match: '_' + match.group(1).lower(), camelcase)
-        else:
-            return camelcase.lower()
+        try:
+            return snake_cases[camelcase]
+        except KeyError:
+            name = uppercase.sub(r'_\1', camelcase.replace('ID', '_id')).lower()
+            snake_cases[camelcase] = name
+            return name
 
 
 class User(Converter):
@@ -65,9 +111,7 @@ class Card(Converter):
         self.type = board.card_types[self.type_id]
         self.history = []
         self._major_changes_ = False
-        self._plan_ = {}
-        self._estimation_ = {}
-        self._achieved_ = {'working hours': {}, 'total hours': {}}
+        self._achieved_ = {}
 
     def __repr__(self):
         return self.external_card_id or self.id
@@ -87,11 +131,19 @@ class Card(Converter):
         """ Returns the class of service, if any """
         return self.board.classes_of_service[self.class_of_service_id] if self.class_of_service_id else None
 
+    @singleton
+    def events(self):
+        """ Returns a dictionary of history events indexed by type, in chronological order """
+        events = {}
+        for event in self.history:
+            events.setdefault(event['Type'], []).append(event)
+        return events
+
     @property
     def creation_date(self):
-        for event in self.history:
-            if event['Type'] == 'CardCreationEventDTO':
-                return event['DateTime']
+        creation = self.events().get('CardCreationEventDTO')
+        if creation:
+            return creation[0]['DateTime']
 
     @property
     def first_date(self):
@@ -110,13 +162,12 @@ class Card(Converter):
         current_time = None
         moves = []
         current_lane = self.board.lanes.get(self.history[0]['ToLaneId'])
-        for event in self.history:
-            if event['Type'] == 'CardMoveEventDTO':
-                current_time = event['DateTime']
-                moves.append({'lane': self.board.lanes.get(event['FromLaneId']),
-                              'in': previous_time, 'out': current_time})
-                previous_time = current_time
-                current_lane = self.board.lanes.get(event['ToLaneId'])
+        for event in self.events().get('CardMoveEventDTO', []):
+            current_time = event['DateTime']
+            moves.append({'lane': self.board.lanes.get(event['FromLaneId']),
+                          'in': previous_time, 'out': current_time})
+            previous_time = current_time
+            current_lane = self.board.lanes.get(event['ToLaneId'])
         moves.append({'lane': current_lane, 'in': current_time or previous_time, 'out': None})
         return moves
 
@@ -126,7 +177,7 @@ class Card(Converter):
         timeline = [move for move in self.moves() if move['out']]
         for move in timeline:
             move['time'] = (move['out'] - move['in']).total_seconds() / 3600
-            move['trt'] = timeutils.working_hours(move['in'], move['out'])
+            move['trt'] = self.board.working_hours(move['in'], move['out'])
         return timeline
 
     @singleton
@@ -134,108 +185,71 @@ class Card(Converter):
         """ Returns a dictionary containing the time data for the
         lanes the card has been through. Doesn't consider the
         time spent in the current one """
-        lanes = {}
-        for event in self.timeline():
-            lane = event['lane']
-            if lane in lanes:
-                lanes[lane]['trt'] += event['trt']
-                lanes[lane]['time'] += event['time']
-                lanes[lane]['out'] = event['out']
-                lanes[lane]['events'] += 1
-            else:
-                lanes[lane] = {'in': event['in'],
-                               'out': event['out'],
-                               'time': event['time'],
-                               'trt': event['trt'],
-                               'events': 1}
-        return lanes
+        return accumulate((event['lane'], event) for event in self.timeline())
 
     @singleton
     def stations(self):
         """ Returns a dictionary containing the time data for the
         stations the card has been through. Doesn't consider the
         time spent in the current one """
-        stations = {}
-        for lane, data in self.lanes().items():
-            station = lane.station if lane else None
-            if station in stations:
-                stations[station]['trt'] += data['trt']
-                stations[station]['time'] += data['time']
-                stations[station]['out'] = data['out']
-                stations[station]['events'] += data['events']
-            else:
-                stations[station] = {'in': data['in'],
-                                     'out': data['out'],
-                                     'time': data['time'],
-                                     'trt': data['trt'],
-                                     'events': data['events']}
-        return stations
+        return accumulate((lane.station if lane else None, data) for lane, data in self.lanes().items())
 
     @singleton
     def phases(self):
         """ Returns a dictionary containing the time data for the
         phases the card has been through. Doesn't consider the
         time spent in the current one """
-        phases = {}
-        for station, data in self.stations().items():
-            phase = station.phase if station else None
-            if phase in phases:
-                phases[phase]['trt'] += data['trt']
-                phases[phase]['time'] += data['time']
-                phases[phase]['out'] = data['out']
-                phases[phase]['events'] += data['events']
-            else:
-                phases[phase] = {'in': data['in'],
-                                 'out': data['out'],
-                                 'time': data['time'],
-                                 'trt': data['trt'],
-                                 'events': data['events']}
-        return phases
+        return accumulate((station.phase if station else None, data) for station, data in self.stations().items())
+
+    @singleton
+    def station_moves(self):
+        """ Returns a tuple of (in, out, station) entries for the
+        card movements that happened within a station """
+        return tuple((move['in'], move['out'], move['lane'].station) for move in self.moves()
+                     if move['lane'] and move['lane'].station)
 
     @singleton
     def trt(self, hours=False):
         """ Total time the card has spent in all stations together """
         total = 0
-        for move in self.moves():
-            if move['lane'] and move['lane'].station:
-                if hours:
-                    total += timeutils.working_hours(move['in'], move['out'] or today())
-                else:
-                    total += ((move['out'] or today()) - move['in']).total_seconds() / 3600
+        now = today()
+        for move_in, move_out, station in self.station_moves():
+            if hours:
+                total += self.board.working_hours(move_in, move_out)
+            else:
+                total += ((move_out or now) - move_in).total_seconds() / 3600
         return total
 
     @property
     def tagset(self):
         """ Returns a list of tags """
         result = []
-        for event in self.history:
-            if event['Type'] == 'CardFieldsChangedEventDTO':
-                for change in event['Changes']:
-                    if change['FieldName'] == 'Tags':
-                        old_tags = change['OldValue'].split(',') if change['OldValue'] else []
-                        new_tags = change['NewValue'].split(',') if change['NewValue'] else []
-                        if new_tags > old_tags:
-                            diff = set(new_tags) - set(old_tags)
-                            result.append({'tag': ','.join(diff), 'date': event['DateTime']})
+        for event in self.events().get('CardFieldsChangedEventDTO', []):
+            for change in event['Changes']:
+                if change['FieldName'] == 'Tags':
+                    old_tags = change['OldValue'].split(',') if change['OldValue'] else []
+                    new_tags = change['NewValue'].split(',') if change['NewValue'] else []
+                    diff = set(new_tags).difference(old_tags)
+                    if diff:
+                        result.append({'tag': ','.join(diff), 'date': event['DateTime']})
         return result
 
     @property
     def comments(self):
         """ Returns a list of comments """
-        result = []
-        for event in self.history:
-            if event['Type'] == 'CommentPostEventDTO':
-                result.append({'text': event['CommentText'], 'date': event['DateTime'], 'user': event['UserName']})
-        return result
+        return [{'text': event['CommentText'], 'date': event['DateTime'], 'user': event['UserName']}
+                for event in self.events().get('CommentPostEventDTO', [])]
 
     @property
+    @singleton
     def start_date(self):
         """ Date in which the card was first moved into a station """
         start_date = None
         for move in self.moves():
-            if not start_date and move['lane'] and move['lane'].station:
+            lane = move['lane']
+            if not start_date and lane and lane.station:
                 start_date = move['in']
-            elif move['lane'] and 'major changes' in move['lane'].title.lower():
+            elif lane and 'major changes' in lane.title.lower():
                 self._major_changes_ = True
                 start_date = move['in']
         return start_date
@@ -268,15 +282,16 @@ class Card(Converter):
             lane = self.lane
         elif isinstance(lane, int):
             lane = self.board.lanes[lane]
-        major_changes = self.major_changes
+        start_date = self.start_date
+        now = today()
         for move in self.moves():
-            if move['in'] < self.start_date:
+            if move['in'] < start_date:
                 continue
             if move['lane'] and move['lane'].id == lane.id:
                 if hours:
-                    total += timeutils.working_hours(move['in'], move['out'] or today())
+                    total += self.board.working_hours(move['in'], move['out'])
                 else:
-                    total += ((move['out'] or today()) - move['in']).total_seconds() / 3600
+                    total += ((move['out'] or now) - move['in']).total_seconds() / 3600
         return total
 
     def trt_station(self, station=None, hours=False):
@@ -291,8 +306,15 @@ class Card(Converter):
                 station = self.station
             elif isinstance(station, int):
                 station = self.board.stations[station]
-            for lane in station.lanes:
-                total += self.trt_lane(lane.id, hours)
+            start_date = self.start_date
+            now = today()
+            for move_in, move_out, move_station in self.station_moves():
+                if move_station is not station or move_in < start_date:
+                    continue
+                if hours:
+                    total += self.board.working_hours(move_in, move_out)
+                else:
+                    total += ((move_out or now) - move_in).total_seconds() / 3600
             return total
 
     def trt_phase(self, phase, hours=False):
@@ -333,50 +355,53 @@ class Card(Converter):
                 station = self.board.stations[station]
             return station.target(self)
 
+    @singleton
     def plan(self):
         """ Returns all the initially planned completion dates for each station """
-        if not self._plan_:
-            ect = self.start_date or today()
-            for position in range(1, max(self.board.stations)+1):
-                station = self.board.stations[position]
-                target = station.target(self)
-                ect = timeutils.due_date(target, ect)
-                self._plan_[position] = {'station': station, 'target': target, 'ect': ect}
-        return self._plan_
+        plan = {}
+        ect = self.start_date or today()
+        for position in range(1, max(self.board.stations)+1):
+            station = self.board.stations[position]
+            target = station.target(self)
+            ect = timeutils.due_date(target, ect)
+            plan[position] = {'station': station, 'target': target, 'ect': ect}
+        return plan
 
+    @singleton
     def estimation(self):
         """ Returns all the predicted completion dates for each remaining station """
         # TODO: estimation from the last known lane
-        if not self._estimation_:
-            if self.station:
-                consumed = self.trt_station(self.station.id, hours=True)
-                target = self.station.target(self)
-                ect = timeutils.due_date(target - consumed, today())
-                self._estimation_[self.station.id] = {'station': self.station, 'target': target, 'ect': ect}
-                for position in range(self.station.id+1, max(self.board.stations)+1):
-                    station = self.board.stations[position]
-                    target = station.target(self)
-                    ect = timeutils.due_date(target, ect)
-                    self._estimation_[position] = {'station': station, 'target': target, 'ect': ect}
-        return self._estimation_
+        estimation = {}
+        if self.station:
+            consumed = self.trt_station(self.station.id, hours=True)
+            target = self.station.target(self)
+            ect = timeutils.due_date(target - consumed, today())
+            estimation[self.station.id] = {'station': self.station, 'target': target, 'ect': ect}
+            for position in range(self.station.id+1, max(self.board.stations)+1):
+                station = self.board.stations[position]
+                target = station.target(self)
+                ect = timeutils.due_date(target, ect)
+                estimation[position] = {'station': station, 'target': target, 'ect': ect}
+        return estimation
 
     def achieved(self, hours=False):
         """ Returns a list of completed stations """
         mode = 'working hours' if hours else 'total hours'
-        data = self._achieved_[mode]
-        if not data:
-            for move in self.moves():
-                if move['lane'] and move['lane'].station and move['out']:
+        data = self._achieved_.get(mode)
+        if data is None:
+            data = self._achieved_[mode] = {}
+            for move_in, move_out, station in self.station_moves():
+                if move_out:
                     if hours:
-                        trt = timeutils.working_hours(move['in'], move['out'])
+                        trt = self.board.working_hours(move_in, move_out)
                     else:
-                        trt = (move['out'] - move['in']).total_seconds() / 3600
-                    station = move['lane'].station
-                    if station.id in data:
-                        data[station.id]['trt'] += trt
-                        data[station.id]['out'] = move['out']
+                        trt = (move_out - move_in).total_seconds() / 3600
+                    slot = data.get(station.id)
+                    if slot is None:
+                        data[station.id] = {'trt': trt, 'in': move_in, 'out': move_out}
                     else:
-                        data[station.id] = {'trt': trt, 'in': move['in'], 'out': move['out']}
+                        slot['trt'] += trt
+                        slot['out'] = move_out
 
             if self.station and self.station.id in data:
                 del data[self.station.id]
@@ -404,29 +429,32 @@ class Lane(Converter):
         return self.path
 
     @property
+    @singleton
     def ascendants(self):
-        """ Returns a list of all parent lanes sorted in ascending order """
+        """ Returns a tuple of all parent lanes sorted in ascending order """
         lanes = []
         lane = self.parent
         while lane:
             lanes.append(lane)
             lane = lane.parent
-        return lanes
+        return tuple(lanes)
 
     @property
+    @singleton
     def descendants(self):
-        """ Returns a list of all child lanes sorted in descending order """
-        def sublanes(lane, array):
-            for child in lane.children:
-                array.append(child)
-                sublanes(child, array)
-            return array
-
-        return sublanes(self, [])
+        """ Returns a tuple of all child lanes sorted in descending order """
+        lanes = []
+        pending = list(reversed(self.children))
+        while pending:
+            lane = pending.pop()
+            lanes.append(lane)
+            pending.extend(reversed(lane.children))
+        return tuple(lanes)
 
     @property
+    @singleton
     def main_lane(self):
-        return ([self] + self.ascendants)[-1]
+        return ((self,) + self.ascendants)[-1]
 
     @property
     def children(self):
@@ -441,12 +469,13 @@ class Lane(Converter):
         return self.board.lanes.get(self.parent_lane_id)
 
     @property
+    @singleton
     def path(self):
         return '::'.join(reversed([self.title] + [lane.title for lane in self.ascendants]))
 
     @property
     def cards(self):
-        return [card for card in self.board.cards.values() if card.lane == self]
+        return list(self.board.cards_by_lane().get(self, []))
 
 
 class Bundle(Converter):
@@ -455,7 +484,7 @@ class Bundle(Converter):
         self.board = board
         self.id = self.position
         self.lanes = [self.board.lanes[lane] for lane in self.lanes]
-        self._cards_ = []
+        self._cards_ = None
         self._moves_ = []
 
     def __repr__(self):
@@ -465,22 +494,23 @@ class Bundle(Converter):
         return self.size * card.size + self.card
 
     def cards(self, include={}, exclude={}):
-        if not self._cards_:
-            for card in self.board.deck(include, exclude):
-                if card.lane in self.lanes:
-                    self._cards_.append(card)
+        if self._cards_ is None:
+            cards_by_lane = self.board.cards_by_lane()
+            self._cards_ = [card for lane in self.lanes for card in cards_by_lane.get(lane, [])]
+        if include or exclude:
+            return select(self._cards_, include, exclude)
         return self._cards_
 
 
 class Station(Bundle):
+    floats = ('card', 'size')
+
     def __init__(self, data, board):
         super(Station, self).__init__(data, board)
         self.board = board
         self.id = self.position
         self.phase = None
         self.group = None
-        self.card = float(self.card)
-        self.size = float(self.size)
         for lane in self.lanes:
             lane.station = self
 
@@ -497,10 +527,10 @@ class Phase(Bundle):
 
 
 class Group(Bundle):
+    floats = ('card', 'size')
+
     def __init__(self, data, board):
         super(Group, self).__init__(data, board)
-        self.card = float(self.card)
-        self.size = float(self.size)
         self._stats_ = None
         for lane in self.lanes:
             lane.groups.append(self)
@@ -509,35 +539,54 @@ class Group(Bundle):
 class Board(Converter):
     def __init__(self, board_id=None, archive=False):
         # TODO: optionally load archived cards
-        board_data = db.boards.find_one({'Id': board_id})
+        board_data = db.boards.find_one({'Id': board_id}, projection)
         assert board_data, "No board with id {} found".format(board_id)
         super(Board, self).__init__(board_data)
-        self.card_types = {card_type['Id']: CardType(card_type, self) for card_type in db.card_types.find({'BoardId': board_id})}
-        self.classes_of_service = {class_of_service['Id']: ClassOfService(class_of_service, self) for class_of_service in db.classes_of_service.find({'BoardId': board_id})}
-        self.users = {user['Id']: User(user, self) for user in db.users.find({'BoardId': board_id})}
-        self.lanes = {lane['Id']: Lane(lane, self) for lane in db.lanes.find({'BoardId': board_id})}
-        self.cards = {card['Id']: Card(card, self) for card in db.cards.find({'BoardId': board_id})}
-        self.stations = {station['Position']: Station(station, self) for station in db.stations.find({'BoardId': board_id})}
-        self.phases = {phase['Position']: Phase(phase, self) for phase in db.phases.find({'BoardId': board_id})}
-        self.groups = [Group(group, self) for group in db.groups.find({'BoardId': board_id})]
+        self._working_hours_ = {}
+        query = {'BoardId': board_id}
+        self.card_types = {card_type['Id']: CardType(card_type, self) for card_type in db.card_types.find(query, projection)}
+        self.classes_of_service = {class_of_service['Id']: ClassOfService(class_of_service, self) for class_of_service in db.classes_of_service.find(query, projection)}
+        self.users = {user['Id']: User(user, self) for user in db.users.find(query, projection)}
+        self.lanes = {lane['Id']: Lane(lane, self) for lane in db.lanes.find(query, projection)}
+        self.cards = {card['Id']: Card(card, self) for card in db.cards.find(query, projection).batch_size(batch_size)}
+        self.stations = {station['Position']: Station(station, self) for station in db.stations.find(query, projection)}
+        self.phases = {phase['Position']: Phase(phase, self) for phase in db.phases.find(query, projection)}
+        self.groups = [Group(group, self) for group in db.groups.find(query, projection)]
 
         # Load history
         # TODO: history has to be available on Card creation
-        events = {}
-        for event in db.events.find({'BoardId': board_id}):
-            if event['CardId'] in events:
-                events[event['CardId']].append(event)
-            else:
-                events[event['CardId']] = [event]
-
-        assert len(self.cards) == len(events), 'Inconsistent number of events: {} - {}'.format(len(self.cards), len(events))
+        events = db.events.find(query, projection).sort([('CardId', 1), ('Position', 1)]).batch_size(batch_size)
+        loaded = 0
+        for card_id, history in groupby(events, key=itemgetter('CardId')):
+            self.cards[card_id].history = list(history)
+            loaded += 1
 
-        for card_id in self.cards:
-            self.cards[card_id].history = sorted(events[card_id], key=lambda event: event['Position'])
+        assert len(self.cards) == loaded, 'Inconsistent number of events: {} - {}'.format(len(self.cards), loaded)
 
     def __repr__(self):
         return self.title
 
+    def working_hours(self, start, end=None):
+        """ Working hours between two dates. Closed intervals never change,
+        so they are memoized for the lifetime of the board; open ones are
+        measured up to now """
+        if not end:
+            return timeutils.working_hours(start, today())
+        try:
+            return self._working_hours_[(start, end)]
+        except KeyError:
+            hours = timeutils.working_hours(start, end)
+            self._working_hours_[(start, end)] = hours
+            return hours
+
+    @singleton
+    def cards_by_lane(self):
+        """ Returns a dictionary of cards indexed by their current lane """
+        cards = {}
+        for card in self.cards.values():
+            cards.setdefault(card.lane, []).append(card)
+        return cards
+
     def deck(self, include={}, exclude={}):
         """ Returns a list of cards matching the a given query.
         Defaults to all cards.
@@ -545,47 +594,38 @@ class Board(Converter):
         :param dict include: attributes of the cards to be included
         :param dict exclude: attributes of the cards to be excluded
         """
-        deck = []
-        for card in self.cards.values():
-            match = True
-            for key, value in include.items():
-                if getattr(card, key, None) != value:
-                    match = False
-            if match:
-                deck.append(card)
-
-        for card in deck[:]:
-            for key, value in exclude.items():
-                if getattr(card, key, None) == value:
-                    deck.remove(card)
-                    break
-
-        return deck
+        return select(self.cards.values(), include, exclude)
 
     @property
+    @singleton
     def sorted_lanes(self):
         lanes = []
         lanes += self.backlog_lanes
         for lane in self.top_level_lanes:
-            lanes += [lane] + lane.descendants
+            lanes.append(lane)
+            lanes += lane.descendants
         lanes += self.archive_lanes
-        return lanes
+        return tuple(lanes)
 
     @property
+    @singleton
     def backlog_lanes(self):
         backlog = self.lanes[self.backlog_top_level_lane_id]
-        return [backlog] + backlog.descendants
+        return (backlog,) + backlog.descendants
 
     @property
+    @singleton
     def archive_lanes(self):
         archive = self.lanes[self.archive_top_level_lane_id]
-        return [archive] + archive.descendants
+        return (archive,) + archive.descendants
 
     @property
+    @singleton
     def wip_lanes(self):
-        return [lane for lane in self.lanes.values() if lane.area == 'wip']
+        return tuple(lane for lane in self.lanes.values() if lane.area == 'wip')
 
     @property
+    @singleton
     def top_level_lanes(self):
-        return [self.lanes[lane_id] for lane_id in self.top_level_lane_ids]
+        return tuple(self.lanes[lane_id] for lane_id in self.top_level_lane_ids)
 
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import yaml
+import threading
 from os import path
 from datetime import datetime
+from contextlib import contextmanager
 import officehours
 
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
 
 conf_paths = ['conf.yaml', path.expanduser('~/.kanpy')]
 conf_path = None
@@ -13,7 +20,7 @@ for conf_path in conf_paths:
         break
 
 with open(conf_path) as settings:
-    conf = yaml.load(settings)
+    conf = yaml.load(settings, Loader=Loader)
 
 log = conf.get('log', {})
 kanban = conf.get('kanban')
@@ -24,5 +31,23 @@ environment = conf.get('environment', 'production')
 
 timeutils = officehours.Calculator(start='8:00', close='16:00')
 timeutils.add_holidays([])  # TODO: move to database
-today = datetime.today
+frozen = threading.local()
+
+
+def today():
+    """ Returns the current date, or the one fixed by an enclosing frozen_today block """
+    return getattr(frozen, 'today', None) or datetime.today()
+
+
+@contextmanager
+def frozen_today():
+    """ Fixes the value returned by today() for the duration of an analysis pass """
+    if getattr(frozen, 'today', None):
+        yield frozen.today
+        return
+    frozen.today = datetime.today()
+    try:
+        yield frozen.today
+    finally:
+        del frozen.today
 
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import time
+import hashlib
+import threading
 import pymongo
+from pymongo.write_concern import WriteConcern
 import logging
-from logging import handlers
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from . import api
 from . import settings
@@ -14,26 +18,51 @@ from .database import db
 log = logging.getLogger(__name__)
 
 
+try:
+    import orjson
+
+    def serialize(content):
+        return orjson.dumps(content, default=str, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    def serialize(content):
+        return json.dumps(content, default=str, sort_keys=True, separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+
+
+def digest(document):
+    """ Returns a hash of the document contents, regardless of its LastUpdate """
+    content = {key: value for key, value in document.items() if key not in ('LastUpdate', 'Hash')}
+    return hashlib.blake2b(serialize(content), digest_size=16).hexdigest()
+
+
 class Worker:
     def __init__(self, throttle=60):
         self.kanban = api.Kanban()
         self.boards = {}
         self.throttle = throttle
+        self.wake = threading.Event()
         self.last_update = time.time()
         self.boards = {board_id: self.load(board_id) for board_id in settings.kanban['boards']}
         self.collections = ['lanes', 'cards', 'users', 'card_types', 'classes_of_service']
+        self.hashed = ['lanes', 'users', 'card_types', 'classes_of_service']
+        # Events can always be downloaded again, so their inserts skip the journal
+        self.events = db.events.with_options(write_concern=WriteConcern(w=1, j=False))
 
     def load(self, board_id):
         return db.boards.find_one({'Id': board_id})
 
-    def find(self, collection, board_id, query={}):
-        query.update({'BoardId': board_id})
-        return {item['Id']: item for item in db[collection].find(query)}
+    def find(self, collection, board_id, query=None, projection=None, session=None):
+        criteria = {'BoardId': board_id}
+        criteria.update(query or {})
+        return {item['Id']: item for item in db[collection].find(criteria, projection, session=session)}
 
     def reset(self):
-        collections = {'boards': ['Id'], 'lanes': ['Id', 'BoardId'], 'cards': ['Id', 'BoardId'],
+        collections = {'boards': ['Id'], 'lanes': ['Id', 'BoardId'],
+                       'cards': ['Id', [('BoardId', 1), ('InCabinet', 1), ('LastActivity', 1), ('Id', 1)]],
                        'users': ['BoardId'], 'card_types': ['Id', 'BoardId'],
-                       'classes_of_service': ['Id', 'BoardId'], 'events': ['BoardId', 'CardId'] }
+                       'classes_of_service': ['Id', 'BoardId'],
+                       'events': [[('BoardId', 1), ('CardId', 1), ('Position', 1)], 'CardId'],
+                       'triggers': [] }
         for collection in collections:
             db[collection].drop()
             for index in collections[collection]:
@@ -43,105 +72,190 @@ class Worker:
                     db[collection].create_index(index)
         self.boards = dict(zip(settings.kanban['boards'], [None]*len(settings.kanban['boards'])))
 
-    def populate(self, board_id):
-        log.info('Populating board {}'.format(board_id))
-        self.kanban.get_board(board_id)
-        board = self.kanban.boards[board_id]
+    def populate(self, board_id, session=None, kanban=None):
+        log.info('Populating board %s', board_id)
+        kanban = kanban or self.kanban
+        kanban.get_board(board_id)
+        board = kanban.boards[board_id]
         board.get_history()
-        db.boards.insert_one(board.jsonify())
         for collection in self.collections:
-            db[collection].remove({'BoardId': board_id})
+            db[collection].delete_many({'BoardId': board_id}, session=session)
             items = [item.jsonify() for item in getattr(board, collection).values()]
-            if len(items) == 1:
-                db[collection].insert(items[0])
-            elif len(items) > 1:
-                db[collection].insert_many(items)
-        db.events.remove({'BoardId': board_id})
+            if collection in self.hashed:
+                for item in items:
+                    item['Hash'] = digest(item)
+            if items:
+                db[collection].insert_many(items, session=session)
+        db.events.delete_many({'BoardId': board_id}, session=session)
         events = [event for card in board.cards.values() for event in card.history]
-        db.events.insert_many(events)
-        self.boards[board_id] = self.load(board_id)
+        if events:
+            self.events.insert_many(events, session=session)
+        document = board.jsonify()
+        db.boards.insert_one(document, session=session)
+        self.boards[board_id] = document
 
     def check(self, board_id):
-        if self.boards[board_id]:
-            version = self.boards[board_id]['Version']
-            if self.kanban.check_updates(board_id, version):
-                board = self.kanban.boards[board_id]
-                log.debug('Updating {} from v{} to v{}'.format(board.title, version, board.version))
-                self.update(board_id)
-        else:
-            self.populate(board_id)
-
-    def update(self, board_id):
-        board = self.kanban.boards[board_id]
+        """ Brings the stored board up to date, issuing all its
+        database operations within one causally consistent session """
+        kanban = self.kanban
+        with db.client.start_session(causal_consistency=True) as session:
+            if self.boards[board_id]:
+                version = self.boards[board_id]['Version']
+                if kanban.check_updates(board_id, version):
+                    board = kanban.boards[board_id]
+                    log.debug('Updating %s from v%s to v%s', board.title, version, board.version)
+                    self.update(board_id, session, kanban)
+            else:
+                self.populate(board_id, session, kanban)
+
+    def update(self, board_id, session=None, kanban=None):
+        board = (kanban or self.kanban).boards[board_id]
         board.get_backlog()
         board.get_archive()  # TODO: get recent archive
 
-        cards = self.find('cards', board_id, {'InCabinet': {'$ne': True}})
-        for card in board.cards.values():
-            if card.id in cards:
-                assert card.last_activity >= cards[card.id]['LastActivity'], \
-                        'Card {} has invalid LastActivity: {} --> {}'.format(card.id, card.last_activity, cards[card.id]['LastActivity'])
-                if card.last_activity > cards[card.id]['LastActivity']:
-                    log.info('Card updated: {}'.format(card.id))
-                    card.get_history()
-                    last_event = [result for result in db.events.find({'CardId': card.id}).sort('Position', -1).limit(1)][0]
-                    for position in range(last_event['Position'], len(card.history)):
-                        db.events.insert(card.history[position])
-                    db.cards.update({'Id': card.id}, card.jsonify())
-            else:
-                log.info('Card created: {}'.format(card.id))
-                card.get_history()
-                db.events.insert_many(card.history)
-                db.cards.insert_one(card.jsonify())
+        cards = self.find('cards', board_id, {'InCabinet': {'$ne': True}}, {'_id': 0, 'Id': 1, 'LastActivity': 1}, session)
+        updated = set()
+        for card_id, card in board.cards.items():
+            stored = cards.get(card_id)
+            if stored:
+                last_activity = card.last_activity
+                if last_activity > stored['LastActivity']:
+                    updated.add(card_id)
+                elif last_activity < stored['LastActivity']:
+                    log.warning('Card %s has invalid LastActivity: %s --> %s', card_id, last_activity, stored['LastActivity'])
+        last_positions = {}
+        if updated:
+            pipeline = [{'$match': {'CardId': {'$in': list(updated)}}},
+                        {'$group': {'_id': '$CardId', 'Position': {'$max': '$Position'}}}]
+            last_positions = {result['_id']: result['Position'] for result in db.events.aggregate(pipeline, session=session)}
 
-        # Check for archived and deleted cards
+        # Check for archived and deleted cards before writing anything, so that a
+        # failed request never leaves new events stored without their card
+        card_ops = []
+        deleted = []
         for card_id in cards:
             if card_id not in board.cards:
                 missing_card = board.get_card(card_id)
                 if missing_card:
-                    log.info("Card archived: {}".format(card_id))
-                    db.cards.update({'CardId': card_id}, {'InCabinet': True})
+                    log.info("Card archived: %s", card_id)
+                    card_ops.append(pymongo.UpdateOne({'Id': card_id}, {'$set': {'InCabinet': True}}))
                 else:
-                    log.info("Card deleted: {}".format(card_id))
-                    db.cards.remove({'Id': card_id})
-                    db.events.remove({'CardId': card_id})
+                    log.info("Card deleted: %s", card_id)
+                    card_ops.append(pymongo.DeleteOne({'Id': card_id}))
+                    deleted.append(card_id)
+
+        event_ops = []
+        for card_id, card in board.cards.items():
+            if card_id in updated:
+                log.info('Card updated: %s', card_id)
+                card.get_history()
+                new_events = card.history[last_positions.get(card_id, 0):]
+                event_ops.extend(pymongo.InsertOne(event) for event in new_events)
+                card_ops.append(pymongo.ReplaceOne({'Id': card_id}, card.jsonify()))
+            elif card_id not in cards:
+                log.info('Card created: %s', card_id)
+                card.get_history()
+                event_ops.extend(pymongo.InsertOne(event) for event in card.history)
+                card_ops.append(pymongo.InsertOne(card.jsonify()))
+
+        if event_ops:
+            self.events.bulk_write(event_ops, ordered=False, session=session)
+        if card_ops:
+            db.cards.bulk_write(card_ops, ordered=False, session=session)
+        if deleted:
+            db.events.delete_many({'CardId': {'$in': deleted}}, session=session)
 
         # Update other databases
-        for collection in ['lanes', 'users', 'card_types', 'classes_of_service']:
-            items = self.find(collection, board_id)
+        for collection in self.hashed:
+            hashes = self.find(collection, board_id, projection={'_id': 0, 'Id': 1, 'Hash': 1}, session=session)
+            operations = []
             for item_id, item in getattr(board, collection).items():
-                if item_id not in items:
+                document = item.jsonify()
+                document['Hash'] = digest(document)
+                stored = hashes.get(item_id)
+                if stored is None:
                     # New item
-                    db[collection].insert_one(item.jsonify())
-                    log.info("{} ({}) added to {} database".format(item.prettify_name(type(item).__name__), item.id, collection))
+                    operations.append(pymongo.InsertOne(document))
+                    change = 'added to'
+                elif stored.get('Hash') != document['Hash']:
+                    # Item updated
+                    operations.append(pymongo.ReplaceOne({'Id': item_id}, document))
+                    change = 'updated in'
                 else:
-                    # Compare dicts
-                    stored = items[item_id]
-                    downloaded = item.jsonify()
-                    downloaded['LastUpdate'] = stored['LastUpdate']
-                    for key, value in downloaded.items():
-                        if stored.get(key) != value:
-                            # Item updated
-                            db[collection].update({'Id': item_id}, item.jsonify())
-                            log.info("{} ({}) updated in {} database".format(item.prettify_name(type(item).__name__), item.id, collection))
+                    continue
+                log.info("%s (%s) %s %s database", item.prettify_name(type(item).__name__), item_id, change, collection)
+            if operations:
+                db[collection].bulk_write(operations, ordered=False, session=session)
 
         # Update board data
-        db.boards.update({'Id': board_id}, board.jsonify())
-        self.boards[board_id] = board.jsonify()
+        document = board.jsonify()
+        db.boards.replace_one({'Id': board_id}, document, session=session)
+        self.boards[board_id] = document
 
 
-    def run(self):
+    def kick(self):
+        """ Wakes up the worker to check the boards without waiting for the throttle """
+        self.wake.set()
+
+    def listen(self):
+        """ Wakes up the worker whenever a document is inserted in the triggers
+        collection, e.g. by a Kanban webhook handler, and deletes it once
+        consumed. Transient errors resume the stream where it left off.
+        Requires a replica set; on a standalone server the worker just
+        keeps polling """
+        resume_token = None
         while True:
             try:
-                self.last_update = time.time()
-                for board_id in self.boards:
-                    self.check(board_id)
-                elapsed = time.time() - self.last_update
-                if elapsed < self.throttle:
-                    time.sleep(self.throttle - elapsed)
-            except ConnectionError:
-                self.kanban = api.Kanban()
-            except KeyboardInterrupt:
-                log.info("Stopped by the user")
-                break
+                with db.triggers.watch([{'$match': {'operationType': 'insert'}}],
+                                       resume_after=resume_token) as stream:
+                    for change in stream:
+                        # Invalidate events are always delivered, e.g. when reset() drops the collection
+                        if change['operationType'] == 'invalidate':
+                            break
+                        resume_token = stream.resume_token
+                        db.triggers.delete_one({'_id': change['documentKey']['_id']})
+                        self.kick()
+                resume_token = None
+            except pymongo.errors.ConnectionFailure as e:
+                # Network errors and primary step-downs
+                log.warning('Change stream interrupted, resuming: %s', e)
+                time.sleep(1)
+            except pymongo.errors.OperationFailure as e:
+                if e.code == 40573:  # Change streams are only supported on replica sets
+                    log.warning('Change streams unsupported, falling back to polling: %s', e)
+                    return
+                if e.code == 286:  # The resume point is no longer in the oplog
+                    log.warning('Change stream history lost, restarting: %s', e)
+                    resume_token = None
+                elif e.has_error_label('ResumableChangeStreamError'):
+                    log.warning('Change stream interrupted, resuming: %s', e)
+                else:
+                    log.error('Change stream failed, falling back to polling: %s', e)
+                    return
+                time.sleep(1)
+            except pymongo.errors.PyMongoError as e:
+                log.error('Change stream failed, falling back to polling: %s', e)
+                return
+
+    def run(self):
+        threading.Thread(target=self.listen, daemon=True).start()
+        with ThreadPoolExecutor(max_workers=max(len(self.boards), 1)) as executor:
+            while True:
+                try:
+                    self.last_update = time.time()
+                    # Let every check of this tick finish before handling any error,
+                    # so that no board is ever processed by two threads at once
+                    futures = [executor.submit(self.check, board_id) for board_id in list(self.boards)]
+                    wait(futures)
+                    for future in futures:
+                        future.result()
+                    elapsed = time.time() - self.last_update
+                    if elapsed < self.throttle:
+                        self.wake.wait(self.throttle - elapsed)
+                    self.wake.clear()
+                except ConnectionError:
+                    self.kanban = api.Kanban()
+                except KeyboardInterrupt:
+                    log.info("Stopped by the user")
+                    break
 